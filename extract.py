@@ -1,68 +1,79 @@
-import xml.etree.ElementTree as ET
+from lxml import etree
+import numpy as np
 import pandas as pd
 
+KML_NS = "{http://www.opengis.net/kml/2.2}"
+
 
 def extract_kml_segments(
     file_path: str,
     output_dir: str = "res",
     segment_slice: tuple = (3, 11),
-    save_csv: bool = True,
+    save_parquet: bool = True,
 ):
     """
-    Extracts segments and points from a KML file and saves them as CSV files.
+    Extracts segments and points from a KML file and saves them as
+    Parquet files.
 
     Parameters:
         file_path (str): Path to the input KML file.
-        output_dir (str): Directory to save the output CSV files.
+        output_dir (str): Directory to save the output Parquet files.
         segment_slice (tuple): Range to slice the segments DataFrame (start, end).
-        save_csv (bool): Whether to save output files or just return them.
+        save_parquet (bool): Whether to save output files or just return them.
 
     Returns:
         tuple: (segments_df, points_df)
     """
-    # Parse the KML
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    namespace = {"kml": "http://www.opengis.net/kml/2.2"}
+    # Stream Placemark elements instead of building the whole tree
+    context = etree.iterparse(
+        file_path, events=("end",), tag=f"{KML_NS}Placemark"
+    )
 
-    # Extract all Placemark elements
     segments = []
-    for placemark in root.findall(".//kml:Placemark", namespace):
-        name = (
-            placemark.find("kml:name", namespace).text
-            if placemark.find("kml:name", namespace) is not None
-            else "Unnamed"
-        )
-        coordinates = placemark.find(
-            ".//kml:coordinates", namespace
-        ).text.strip()
+    for _, placemark in context:
+        name_elem = placemark.find(f"{KML_NS}name")
+        name = name_elem.text if name_elem is not None else "Unnamed"
+        coordinates = placemark.find(f".//{KML_NS}coordinates").text.strip()
+
+        # Parse "lon,lat[,alt] lon,lat[,alt] ..." in a single C-level pass
+        n_dims = coordinates.split(None, 1)[0].count(",") + 1
+        coords_arr = np.fromstring(
+            coordinates.replace(",", " "), sep=" ", dtype=np.float64
+        ).reshape(-1, n_dims)
 
-        coords_list = [
-            tuple(map(float, coord.strip().split(",")))
-            for coord in coordinates.split()
-        ]
+        segments.append({"Name": name, "Coordinates": coords_arr})
 
-        segments.append({"Name": name, "Coordinates": coords_list})
+        # Free the processed Placemark and any already-visited siblings
+        placemark.clear()
+        while placemark.getprevious() is not None:
+            del placemark.getparent()[0]
 
     # Create DataFrame
     segments_df = pd.DataFrame(segments)
 
     # Split points and segments
-    points_df = segments_df[
-        segments_df["Coordinates"].apply(lambda x: len(x) == 1)
-    ]
-    segments_df = segments_df[
-        segments_df["Coordinates"].apply(lambda x: len(x) > 1)
-    ]
+    n_coords = segments_df["Coordinates"].map(lambda arr: arr.shape[0])
+    points_df = segments_df[n_coords == 1]
+    segments_df = segments_df[n_coords > 1]
 
     # Slice desired segments
     segments_df = segments_df.iloc[segment_slice[0] : segment_slice[1]]
 
-    if save_csv:
-        points_df.to_csv(f"{output_dir}/points.csv", index=False)
-        segments_df.to_csv(f"{output_dir}/segments.csv", index=False)
-        print(f"✅ Saved points to '{output_dir}/points.csv'")
-        print(f"✅ Saved segments to '{output_dir}/segments.csv'")
+    if save_parquet:
+        # Arrow stores each (N, D) array as a list<list<double>> column
+        def to_arrow_coords(df):
+            return df.assign(
+                Coordinates=df["Coordinates"].map(lambda arr: arr.tolist())
+            )
+
+        to_arrow_coords(points_df).to_parquet(
+            f"{output_dir}/points.parquet", index=False
+        )
+        to_arrow_coords(segments_df).to_parquet(
+            f"{output_dir}/segments.parquet", index=False
+        )
+        print(f"✅ Saved points to '{output_dir}/points.parquet'")
+        print(f"✅ Saved segments to '{output_dir}/segments.parquet'")
 
     return segments_df, points_df
 
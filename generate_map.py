@@ -1,26 +1,31 @@
 # %%
-import ast
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-from shapely import Point
-from shapely.geometry import LineString
+import shapely
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
-from matplotlib.colors import LightSource
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import rasterio
+from rasterio.windows import Window, bounds as window_bounds, from_bounds
 import osmnx as ox
 
 from extract import extract_kml_segments
-from utils import filter_and_smooth_geometries, stylize_natural_geometries
+from utils import (
+    compute_hillshade,
+    filter_and_smooth_geometries,
+    stylize_natural_geometries,
+)
 
 RES_DIR = "res"
 OUTPUT_DIR = "output"
 KML_FILEPATH = f"{RES_DIR}/whw.kml"
-SEGMENTS_CSV_FILEPATH = f"{RES_DIR}/segments.csv"
-POINTS_CSV_FILEPATH = f"{RES_DIR}/points.csv"
+SEGMENTS_FILEPATH = f"{RES_DIR}/segments.parquet"
+POINTS_FILEPATH = f"{RES_DIR}/points.parquet"
 
 ELEVATION_FILEPATH = f"{RES_DIR}/whw.tif"
 NATURE_FILEPATH = f"{RES_DIR}/cached_nature.gpkg"
@@ -28,8 +33,20 @@ LAKES_FILEPATH = f"{RES_DIR}/cached_lakes_scotland.gpkg"
 OUTPUT_FILEPATH = f"{OUTPUT_DIR}/whw.pdf"
 
 SAVE_MAP = True
-DPI = 500
+# Only rasterized layers depend on the save DPI. At 300 DPI the axes are
+# ~3800 px wide for a ~5700-column DEM window, so the hillshade is
+# downsampled ~1.5:1 (native resolution would be ~450 DPI). Vector
+# layers are resolution-independent.
+DPI = 300
+FIGURE_DPI = 100
+# Layers below this zorder (hillshade, rivers, nature, lakes) are merged
+# into a single raster image in the PDF; the route and points stay vector
+RASTER_ZORDER = 11
 BUFFER = 0.1
+# Metric CRS in which all vector processing (areas, buffers) is done
+WORKING_CRS = "EPSG:3857"
+# Route simplification tolerance in degrees (~10 m, sub-pixel at DPI)
+ROUTE_SIMPLIFY_TOLERANCE = 0.0001
 
 # ------------------------- Style Settings --------------------------- #
 WATER_COLOR = "#8aa6a3"
@@ -60,27 +77,35 @@ for path in [RES_DIR, OUTPUT_DIR]:
 # -------------------------------------------------------------------- #
 # Load or extract route data
 # -------------------------------------------------------------------- #
-if not os.path.exists(SEGMENTS_CSV_FILEPATH) or not os.path.exists(
-    POINTS_CSV_FILEPATH
+if not os.path.exists(SEGMENTS_FILEPATH) or not os.path.exists(
+    POINTS_FILEPATH
 ):
     print("📡 Extracting segments and points from KML...")
-    _, _ = extract_kml_segments(KML_FILEPATH, output_dir="res", save_csv=True)
+    # Reuse the freshly extracted DataFrames instead of reading them back
+    segments_df, points_df = extract_kml_segments(
+        KML_FILEPATH, output_dir="res", save_parquet=True
+    )
 else:
-    print("✅ Loading existing CSV files for segments and points...")
-
-segments_df = pd.read_csv(SEGMENTS_CSV_FILEPATH)
-points_df = pd.read_csv(POINTS_CSV_FILEPATH)
-
+    print("✅ Loading existing Parquet files for segments and points...")
+    segments_df = pd.read_parquet(SEGMENTS_FILEPATH)
+    points_df = pd.read_parquet(POINTS_FILEPATH)
+
+
+# Build all route LineStrings in one vectorized call from stacked coords
+segment_coords = [
+    np.vstack(coords)[:, :2] for coords in segments_df["Coordinates"]
+]
+segment_indices = np.repeat(
+    np.arange(len(segment_coords)),
+    [len(coords) for coords in segment_coords],
+)
+route_geoms = shapely.linestrings(
+    np.concatenate(segment_coords), indices=segment_indices
+)
 
 gdf_combined = gpd.GeoDataFrame(
-    {
-        "name": segments_df["Name"],
-        "geometry": [
-            LineString(coords)
-            for coords in segments_df["Coordinates"].apply(eval)
-        ],
-    },
-    geometry="geometry",
+    {"name": segments_df["Name"]},
+    geometry=route_geoms,
     crs="EPSG:4326",
 )
 
@@ -89,14 +114,34 @@ minx, miny, maxx, maxy = gdf_combined.total_bounds
 center_x = (minx + maxx) / 2
 center_y = (miny + maxy) / 2
 
+map_height = maxy - miny
+map_width = map_height * 1.57
+
+# Visible map area as [west, east, south, north]
+map_extent = [
+    center_x - map_width / 2 - BUFFER,
+    center_x + map_width / 2 + BUFFER,
+    miny - BUFFER,
+    maxy + BUFFER,
+]
+# Same area as (minx, miny, maxx, maxy), used to skip unseen features
+map_bbox = (map_extent[0], map_extent[2], map_extent[1], map_extent[3])
+
 # -------------------------------------------------------------------- #
 # Create base map
 # -------------------------------------------------------------------- #
+# Let matplotlib drop sub-pixel vertices and split long paths at draw time
+plt.rcParams["path.simplify"] = True
+plt.rcParams["path.simplify_threshold"] = 1.0
+plt.rcParams["agg.path.chunksize"] = 10000
+plt.rcParams["pdf.compression"] = 9
+
 fig, ax = plt.subplots(
     figsize=(16.5, 16.5 * 1.60),
-    dpi=DPI,
+    dpi=FIGURE_DPI,
     subplot_kw={"projection": ccrs.PlateCarree()},
 )
+ax.set_rasterization_zorder(RASTER_ZORDER)
 
 
 # -------------------------------------------------------------------- #
@@ -104,20 +149,30 @@ fig, ax = plt.subplots(
 # -------------------------------------------------------------------- #
 print("⛰️  Loading elevation data...")
 with rasterio.open(ELEVATION_FILEPATH) as src:
-    dem = src.read(1)
-    extent = [
-        src.bounds.left,
-        src.bounds.right,
-        src.bounds.bottom,
-        src.bounds.top,
-    ]
+    # Only read the part of the DEM that falls inside the map, rounding
+    # outwards so the hillshade still covers the whole map extent
+    exact = from_bounds(*map_bbox, transform=src.transform)
+    window = Window.from_slices(
+        (
+            math.floor(exact.row_off),
+            math.ceil(exact.row_off + exact.height),
+        ),
+        (
+            math.floor(exact.col_off),
+            math.ceil(exact.col_off + exact.width),
+        ),
+    ).intersection(Window(0, 0, src.width, src.height))
+    dem = src.read(1, window=window)
+    left, bottom, right, top = window_bounds(window, src.transform)
+    extent = [left, right, bottom, top]
 
 # # Upscale DEM data (e.g., 2x resolution for sharper raster)
 # dem = zoom(dem, 2, order=3)
 
 print("🌄 Generating hillshade...")
-ls = LightSource(azdeg=315, altdeg=45)
-hillshade = ls.hillshade(dem, vert_exag=1.5, dx=1, dy=1)
+hillshade = compute_hillshade(
+    dem, azdeg=315, altdeg=45, vert_exag=1.5, dx=1, dy=1
+)
 
 ax.imshow(
     hillshade,
@@ -130,36 +185,11 @@ ax.imshow(
 )
 
 # -------------------------------------------------------------------- #
-# Load nature features (forests, grass, etc.)
+# Load nature features (forests, grass, etc.) and lakes
 # -------------------------------------------------------------------- #
 
-if os.path.exists(NATURE_FILEPATH):
-    print("🌲 Loading cached nature data...")
-    gdf_nature = gpd.read_file(NATURE_FILEPATH)
-else:
-    print("🛰️  Downloading nature data from OSM...")
-    all_nature_tags = {
-        "natural": [
-            "wood",
-            "grassland",
-            "heath",
-            "scrub",
-            "wetland",
-            "tundra",
-        ],
-        "landuse": ["forest", "meadow", "farmland", "grass", "orchard"],
-        "landcover": ["grass", "crop"],
-        "leisure": ["nature_reserve", "park"],
-    }
-
-    gdf_nature = ox.features_from_point(
-        (center_y, center_x), dist=70000, tags=all_nature_tags
-    )
-    gdf_nature.to_file(NATURE_FILEPATH, driver="GPKG")
-    print(f"💾 Saved to cache: {NATURE_FILEPATH}")
 
-
-def classify(row):
+def classify(gdf):
     grass_tags = {
         "natural": ["heath"],
         "landuse": ["meadow", "farmland", "grass", "orchard"],
@@ -171,18 +201,111 @@ def classify(row):
         "natural": ["wood", "tundra"],
     }
 
-    if row.get("natural") in forest_tags["natural"]:
-        return "forest"
-    elif row.get("landuse") in forest_tags["landuse"]:
-        return "forest"
-    elif row.get("natural") in grass_tags["natural"]:
-        return "grass"
+    # Tag columns may be missing depending on the OSM response
+    missing = pd.Series(None, index=gdf.index, dtype=object)
+    natural = gdf.get("natural", missing)
+    landuse = gdf.get("landuse", missing)
+
+    is_forest = natural.isin(forest_tags["natural"]) | landuse.isin(
+        forest_tags["landuse"]
+    )
+    is_grass = ~is_forest & natural.isin(grass_tags["natural"])
+
+    category = pd.Series("other", index=gdf.index, dtype=object)
+    category[is_forest] = "forest"
+    category[is_grass] = "grass"
+    return category
+
+
+def load_nature():
+    if os.path.exists(NATURE_FILEPATH):
+        gdf_nature = gpd.read_file(NATURE_FILEPATH, bbox=map_bbox)
     else:
-        return "other"
+        all_nature_tags = {
+            "natural": [
+                "wood",
+                "grassland",
+                "heath",
+                "scrub",
+                "wetland",
+                "tundra",
+            ],
+            "landuse": ["forest", "meadow", "farmland", "grass", "orchard"],
+            "landcover": ["grass", "crop"],
+            "leisure": ["nature_reserve", "park"],
+        }
+
+        gdf_nature = ox.features_from_point(
+            (center_y, center_x), dist=70000, tags=all_nature_tags
+        )
+        gdf_nature.to_file(NATURE_FILEPATH, driver="GPKG")
+        # Keep the same features a cached read would return
+        gdf_nature = gdf_nature.cx[
+            map_bbox[0] : map_bbox[2], map_bbox[1] : map_bbox[3]
+        ]
+
+    gdf_nature = gdf_nature.to_crs(WORKING_CRS)
+    gdf_nature["category"] = classify(gdf_nature)
+    gdf_nature = stylize_natural_geometries(
+        gdf_nature, area_threshold_m2=170000
+    )
+    return gdf_nature.to_crs("EPSG:4326")
+
+
+def load_lakes():
+    if os.path.exists(LAKES_FILEPATH):
+        gdf_lakes_osm = gpd.read_file(LAKES_FILEPATH, bbox=map_bbox)
+    else:
+        gdf_lakes_osm = ox.features_from_point(
+            (center_y, center_x),
+            dist=70000,
+            tags={
+                "natural": ["water"],
+                "water": [
+                    "lake",
+                    "reservoir",
+                    "river",
+                    "stream",
+                ],
+            },
+        )
+        gdf_lakes_osm.to_file(LAKES_FILEPATH, driver="GPKG")
+        # Keep the same features a cached read would return
+        gdf_lakes_osm = gdf_lakes_osm.cx[
+            map_bbox[0] : map_bbox[2], map_bbox[1] : map_bbox[3]
+        ]
+
+    gdf_lakes_osm = gdf_lakes_osm.to_crs(WORKING_CRS)
+    gdf_lakes_osm = filter_and_smooth_geometries(
+        gdf_lakes_osm, area_threshold_m2=150000
+    )
+    return gdf_lakes_osm.to_crs("EPSG:4326")
 
 
-gdf_nature["category"] = gdf_nature.apply(classify, axis=1)
-gdf_nature = stylize_natural_geometries(gdf_nature, area_threshold_m2=170000)
+# Report progress from the main thread so worker output doesn't interleave
+nature_cached = os.path.exists(NATURE_FILEPATH)
+lakes_cached = os.path.exists(LAKES_FILEPATH)
+if nature_cached:
+    print("🌲 Loading cached nature data...")
+else:
+    print("🛰️  Downloading nature data from OSM...")
+if lakes_cached:
+    print("🏞️  Loading cached lake data...")
+else:
+    print("📥 Downloading lakes from OSM...")
+
+# Both layers are independent and spend most of their time in network
+# I/O or GEOS calls, which release the GIL, so fetch them concurrently
+with ThreadPoolExecutor(max_workers=2) as executor:
+    nature_future = executor.submit(load_nature)
+    lakes_future = executor.submit(load_lakes)
+    gdf_nature = nature_future.result()
+    gdf_lakes_osm = lakes_future.result()
+
+if not nature_cached:
+    print(f"💾 Saved to cache: {NATURE_FILEPATH}")
+if not lakes_cached:
+    print(f"💾 Saved lakes to: {LAKES_FILEPATH}")
 
 
 nature_colors = {
@@ -191,50 +314,23 @@ nature_colors = {
 }
 
 print("🌳 Plotting nature features...")
-for cat, group in gdf_nature.groupby("category"):
-    if cat in nature_colors:
-        color = nature_colors.get(cat, "#cccccc")
-        group.plot(
-            ax=ax,
-            facecolor=color,
-            edgecolor="none",
-            alpha=NATURE_ALPHA,
-            zorder=6,
-            label=cat,
-        )
+# Draw every styled category as a single collection
+gdf_nature = gdf_nature[gdf_nature["category"].isin(nature_colors)]
+gdf_nature.plot(
+    ax=ax,
+    facecolor=gdf_nature["category"].map(nature_colors).values,
+    edgecolor="none",
+    alpha=NATURE_ALPHA,
+    zorder=6,
+)
 
 # -------------------------------------------------------------------- #
-# Load lakes
+# Plot lakes
 # -------------------------------------------------------------------- #
 
 ax.add_feature(cfeature.OCEAN, facecolor=WATER_COLOR, zorder=20)
 ax.add_feature(cfeature.RIVERS, linewidth=1, color=WATER_COLOR, zorder=5)
 
-if os.path.exists(LAKES_FILEPATH):
-    print("🏞️  Loading cached lake data...")
-    gdf_lakes_osm = gpd.read_file(LAKES_FILEPATH)
-else:
-    print("📥 Downloading lakes from OSM...")
-    gdf_lakes_osm = ox.features_from_point(
-        (center_y, center_x),
-        dist=70000,
-        tags={
-            "natural": ["water"],
-            "water": [
-                "lake",
-                "reservoir",
-                "river",
-                "stream",
-            ],
-        },
-    )
-    gdf_lakes_osm.to_file(LAKES_FILEPATH, driver="GPKG")
-    print(f"💾 Saved lakes to: {LAKES_FILEPATH}")
-
-gdf_lakes_osm = filter_and_smooth_geometries(
-    gdf_lakes_osm, area_threshold_m2=150000
-)
-
 gdf_lakes_osm.plot(
     ax=ax,
     color=WATER_COLOR,
@@ -247,14 +343,17 @@ gdf_lakes_osm.plot(
 # -------------------------------------------------------------------- #
 # Plot route and points of interest
 # -------------------------------------------------------------------- #
-points_df["geometry"] = points_df["Coordinates"].apply(
-    lambda coord: Point(
-        ast.literal_eval(coord)[0][0], ast.literal_eval(coord)[0][1]
-    )
+# Each point holds a single (lon, lat, alt) coordinate
+point_coords = np.array(
+    [coords[0][:2] for coords in points_df["Coordinates"]], dtype=np.float64
+).reshape(-1, 2)
+
+points_gdf = gpd.GeoDataFrame(
+    points_df,
+    geometry=gpd.points_from_xy(point_coords[:, 0], point_coords[:, 1]),
+    crs="EPSG:4326",
 )
 
-points_gdf = gpd.GeoDataFrame(points_df, geometry="geometry", crs="EPSG:4326")
-
 points_gdf.plot(
     ax=ax,
     color=STEP_COLOR,
@@ -266,6 +365,11 @@ points_gdf.plot(
     linewidth=3,
 )
 
+gdf_combined = gdf_combined.set_geometry(
+    shapely.simplify(gdf_combined.geometry.values, ROUTE_SIMPLIFY_TOLERANCE),
+    crs=gdf_combined.crs,
+)
+
 gdf_combined.plot(
     ax=ax, color=ROUTE_COLOR, linewidth=3, edgecolor=ROUTE_COLOR, zorder=12
 )
@@ -273,22 +377,11 @@ gdf_combined.plot(
 # -------------------------------------------------------------------- #
 # Set final map extent and save
 # -------------------------------------------------------------------- #
-map_height = maxy - miny
-map_width = map_height * 1.57
-
-ax.set_extent(
-    [
-        center_x - map_width / 2 - BUFFER,
-        center_x + map_width / 2 + BUFFER,
-        miny - BUFFER,
-        maxy + BUFFER,
-    ],
-    crs=ccrs.PlateCarree(),
-)
+ax.set_extent(map_extent, crs=ccrs.PlateCarree())
 
 
 if SAVE_MAP:
-    print(f"💾 Saving final vector map as PDF using {DPI} DPI")
+    print(f"💾 Saving final map as PDF using {DPI} DPI")
     plt.savefig(OUTPUT_FILEPATH, format="pdf", bbox_inches="tight", dpi=DPI)
 
 print(f"✅ Map successfully saved as '{OUTPUT_FILEPATH}'")
@@ -1,8 +1,12 @@
 # -------------------------------------------------------------------- #
 # Utility Functions
 # -------------------------------------------------------------------- #
+import math
+
 import geopandas as gpd
-from shapely import MultiPolygon, unary_union
+import numpy as np
+import shapely
+from numba import njit, prange
 
 
 def filter_and_smooth_geometries(
@@ -10,52 +14,50 @@ def filter_and_smooth_geometries(
     area_threshold_m2=10000,
     smooth_strength_m=10,
     simplify_factor=3,
-    input_crs="EPSG:4326",
-    working_crs="EPSG:3857",
 ):
     """
     Filters out small geometries and smooths the shape of polygons
     using buffering and simplification techniques.
 
     Parameters:
-        gdf: The input geometries (in WGS 84 / EPSG:4326).
+        gdf: The input geometries, already in a metric CRS
+            (e.g., EPSG:3857).
         area_threshold_m2: Minimum area (in m²) to retain a shape.
         smooth_strength_m: Strength of smoothing, via positive/negative
             buffer.
         simplify_factor: Geometry simplification factor (higher = more
             simplified).
-        input_crs: CRS of the input data (typically EPSG:4326).
-        working_crs: Metric CRS used for area/smoothing
-            (e.g., EPSG:3857).
 
     Returns:
-        GeoDataFrame: Cleaned and smoothed geometries, in the original
-        CRS.
+        GeoDataFrame: Cleaned and smoothed geometries, in the input CRS.
     """
 
-    # Reproject to metric CRS for area calculation and buffering
-    gdf_m = gdf.to_crs(working_crs)
-
     # Calculate geometry area in square meters
-    gdf_m["area_m2"] = gdf_m.geometry.area
+    area_m2 = shapely.area(gdf.geometry.values)
+
+    # Filter out small geometries before any expensive geometry work
+    mask = area_m2 > area_threshold_m2
+    geoms = gdf.geometry.values[mask]
 
-    # Filter out small geometries
-    gdf_filtered = gdf_m[gdf_m["area_m2"] > area_threshold_m2].copy()
+    # Cheaply drop redundant vertices so the buffer pair has less to do
+    geoms = shapely.simplify(geoms, simplify_factor, preserve_topology=True)
 
     # Smooth geometry using buffer-in/buffer-out trick
-    gdf_filtered["geometry"] = gdf_filtered.geometry.buffer(
-        smooth_strength_m
-    ).buffer(-smooth_strength_m)
+    geoms = shapely.buffer(
+        shapely.buffer(geoms, smooth_strength_m), -smooth_strength_m
+    )
 
     # Simplify geometry to reduce complexity (preserving topology)
-    gdf_filtered["geometry"] = gdf_filtered.geometry.simplify(
-        simplify_factor, preserve_topology=True
+    geoms = shapely.simplify(geoms, simplify_factor, preserve_topology=True)
+
+    # Build the result from the processed array instead of copying the
+    # filtered frame and overwriting its geometry
+    return gpd.GeoDataFrame(
+        gdf.loc[mask].drop(columns=gdf.geometry.name),
+        geometry=geoms,
+        crs=gdf.crs,
     )
 
-    # Reproject back to the original input CRS
-    gdf_final = gdf_filtered.to_crs(input_crs)
-    return gdf_final
-
 
 def stylize_natural_geometries(
     gdf,
@@ -63,8 +65,6 @@ def stylize_natural_geometries(
     proximity_threshold_m=10,
     smooth_strength_m=5,
     simplify_factor=2,
-    input_crs="EPSG:4326",
-    working_crs="EPSG:3857",
 ):
     """
     Processes and styles natural land cover data:
@@ -74,53 +74,115 @@ def stylize_natural_geometries(
     - Returns final styled shapes grouped by 'category'
 
     Parameters:
-        gdf: Input data with natural/landuse elements.
+        gdf: Input data with natural/landuse elements, already in a
+            metric CRS (e.g., EPSG:3857).
         area_threshold_m2: Minimum polygon area to keep.
         proximity_threshold_m: Buffer size to merge nearby features.
         smooth_strength_m: Smoothing via buffer (optional).
         simplify_factor: Simplification tolerance.
-        input_crs: Original CRS of the data.
-        working_crs: Projected CRS for calculations.
 
     Returns:
-        GeoDataFrame: Styled polygons per land cover category in
-        original CRS.
+        GeoDataFrame: Styled polygons per land cover category in the
+        input CRS.
     """
 
-    # Reproject to metric CRS for area and buffering
-    gdf = gdf.to_crs(working_crs)
+    # Calculate area and keep large shapes of a styled category
+    area_m2 = shapely.area(gdf.geometry.values)
+    mask = (area_m2 > area_threshold_m2) & (
+        gdf["category"].values != "other"
+    )
 
-    # Calculate area and filter out small shapes
-    gdf["area_m2"] = gdf.geometry.area
-    gdf = gdf[gdf["area_m2"] > area_threshold_m2].copy()
+    # Merge nearby shapes: buffer everything at once, then union each
+    # category into one geometry
+    fused = gpd.GeoDataFrame(
+        {"category": gdf["category"].values[mask]},
+        geometry=shapely.buffer(
+            gdf.geometry.values[mask], proximity_threshold_m
+        ),
+        crs=gdf.crs,
+    ).dissolve(by="category")
 
-    final_geoms = []
+    geoms = fused.geometry.values
 
-    # Process each category separately
-    for cat, group in gdf.groupby("category"):
-        if cat != "other":
-            # Merge nearby shapes with buffering
-            buffered = group.geometry.buffer(proximity_threshold_m)
+    # Optional: smooth the result with a buffer
+    if smooth_strength_m > 0:
+        geoms = shapely.buffer(geoms, smooth_strength_m)
 
-            # Union all geometries into one
-            fused = unary_union(buffered)
+    # Simplify the resulting shapes
+    geoms = shapely.simplify(geoms, simplify_factor, preserve_topology=True)
 
-            # Optional: smooth the result with a buffer
-            if smooth_strength_m > 0:
-                fused = fused.buffer(smooth_strength_m)
+    # Explode MultiPolygons into one Polygon per row
+    parts, part_index = shapely.get_parts(geoms, return_index=True)
+
+    return gpd.GeoDataFrame(
+        {"category": fused.index.values[part_index]},
+        geometry=parts,
+        crs=gdf.crs,
+    )
 
-            # Simplify the resulting shape
-            simplified = fused.simplify(
-                simplify_factor, preserve_topology=True
-            )
 
-            # Ensure output is MultiPolygon-compatible
-            if isinstance(simplified, (MultiPolygon,)):
-                for geom in simplified.geoms:
-                    final_geoms.append({"category": cat, "geometry": geom})
-            else:
-                final_geoms.append({"category": cat, "geometry": simplified})
+@njit(parallel=True, cache=True)
+def _hillshade_kernel(dem, light, vert_exag, dx, dy, out):
+    """
+    Writes the unnormalized illumination of each DEM cell into `out`,
+    reading the DEM once with no intermediate gradient/normal arrays.
+    """
+    height, width = dem.shape
+    for i in prange(height):
+        # Central differences inside, one-sided at the edges (np.gradient)
+        i0 = max(i - 1, 0)
+        i1 = min(i + 1, height - 1)
+        for j in range(width):
+            j0 = max(j - 1, 0)
+            j1 = min(j + 1, width - 1)
+            gx = vert_exag * (dem[i, j1] - dem[i, j0]) / ((j1 - j0) * dx)
+            gy = vert_exag * (dem[i1, j] - dem[i0, j]) / ((i1 - i0) * dy)
+
+            # Dot product of the unit surface normal (-gx, -gy, 1)
+            # with the light direction
+            out[i, j] = (
+                -gx * light[0] - gy * light[1] + light[2]
+            ) / math.sqrt(gx * gx + gy * gy + 1.0)
+
+
+def compute_hillshade(dem, azdeg=315, altdeg=45, vert_exag=1, dx=1, dy=1):
+    """
+    Computes a hillshade equivalent to matplotlib's
+    `LightSource(azdeg, altdeg).hillshade(...)` using a fused,
+    parallel Numba kernel.
+
+    Parameters:
+        dem: 2D elevation array.
+        azdeg: Azimuth of the light source (degrees clockwise from
+            north).
+        altdeg: Altitude of the light source (degrees above the
+            horizon).
+        vert_exag: Vertical exaggeration applied to the elevation.
+        dx: Cell spacing along columns.
+        dy: Cell spacing along rows.
+
+    Returns:
+        ndarray: Illumination intensity in the range [0, 1].
+    """
+    az = math.radians(90 - azdeg)
+    alt = math.radians(altdeg)
+    light = np.array(
+        [
+            math.cos(az) * math.cos(alt),
+            math.sin(az) * math.cos(alt),
+            math.sin(alt),
+        ]
+    )
 
-    # Return as GeoDataFrame in original CRS
-    gdf_result = gpd.GeoDataFrame(final_geoms, crs=working_crs)
-    return gdf_result.to_crs(input_crs)
+    # The first DEM row is the top of the image, so dy is negative
+    dem = np.asarray(dem, dtype=np.float64)
+    intensity = np.empty_like(dem)
+    _hillshade_kernel(dem, light, vert_exag, dx, -dy, intensity)
+
+    # Rescale to the full [0, 1] range, as LightSource does
+    imin, imax = intensity.min(), intensity.max()
+    if (imax - imin) > 1e-6:
+        intensity -= imin
+        intensity /= imax - imin
+    np.clip(intensity, 0, 1, out=intensity)
+    return intensity